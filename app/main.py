@@ -1,5 +1,13 @@
+import array
+import bisect
+import codecs
+import contextlib
+import functools
+import mmap
+import os
 import struct
 import sys
+import types
 from collections import namedtuple
 
 import app.parser as parser
@@ -9,31 +17,11 @@ def main():
     database_file_path = sys.argv[1]
     command = sys.argv[2]
 
-    with open(database_file_path, "rb") as database_file:
-        database_file.seek(16)  # Skip the first 16 bytes of the header
-        page_size = int.from_bytes(database_file.read(2), byteorder="big")
-
-        database_file.seek(20)
-        page_reserved_space_size = int.from_bytes(
-            database_file.read(1), byteorder="big"
-        )
-
-        database_file.seek(56)
-        text_encoding = ["utf-8", "utf-16-le", "utf-16-be"][
-            int.from_bytes(database_file.read(4), byteorder="big") - 1
-        ]
-
-        db_config = DBConfig(
-            page_size=page_size,
-            text_encoding=text_encoding,
-            page_reserved=page_reserved_space_size,
-        )
-
+    with open_database(database_file_path) as db:
         if command == ".dbinfo":
-            print(f"database page size: {page_size}")
+            print(f"database page size: {db.page_size}")
 
-            database_file.seek(0)
-            page = database_file.read(page_size)
+            page = get_page(db, 1)
             btree_header = parse_btree_header(page, is_first_page=True)[0]
             print(f"number of tables: {btree_header.cell_count}")
 
@@ -41,12 +29,14 @@ def main():
             print(
                 " ".join(
                     row.tbl_name
-                    for row in select_all_from_sqlite_schema(database_file, db_config)
-                    if row.type == "table" and not row.tbl_name.startswith("sqlite_")
+                    for row in select_all_from_sqlite_schema(
+                        db, columns=("tbl_name",), type_="table"
+                    )
+                    if not row.tbl_name.startswith("sqlite_")
                 )
             )
         else:
-            stmt = next(parser.parse(command))
+            stmt = parser.parse_cached(command)[0]
 
             if not isinstance(stmt, parser.SelectStmt):
                 print("Only know select", file=sys.stderr)
@@ -74,41 +64,14 @@ def main():
                 )
                 indexes = []
             else:
-                # FIXME: be more efficient
-                table_schema = None
-                indexes = []
-                for sqlite_schema in select_all_from_sqlite_schema(
-                    database_file, db_config
-                ):
-                    if sqlite_schema.tbl_name.casefold() != table_name.casefold():
-                        continue
-                    elif sqlite_schema.type == "table":
-                        table_schema = sqlite_schema
-                    elif sqlite_schema.type == "index":
-                        indexes.append(sqlite_schema)
-
-                if table_schema is None:
+                table_entry = db.schema_index.get(table_name.casefold())
+                if table_entry is None:
                     print(f"Unknown table '{table_name}'", file=sys.stderr)
                     return 1
+                table_schema, indexes = table_entry
 
-            create_table_ast = next(parser.parse(table_schema.sql))
-            assert isinstance(create_table_ast, parser.CreateTableStmt)
-
-            column_order = {
-                name.casefold(): i
-                for i, (name, _type) in enumerate(create_table_ast.columns)
-            }
-            column_order["rowid".casefold()] = ROWID_COL_IDX
-
-            primary_key_column_idx = next(
-                (
-                    column_index
-                    for column_index, column in enumerate(create_table_ast.columns)
-                    if column.type.casefold().startswith(
-                        "integer primary key".casefold()
-                    )
-                ),
-                None,
+            _create_table_ast, column_order, primary_key_column_idx = (
+                compile_table_schema(str(table_schema.sql))
             )
 
             table_info = TableInfo(
@@ -153,12 +116,9 @@ def main():
                 filter_column_name = stmt.where.lhs.name
 
                 for index_schema in indexes:
-                    create_index = next(parser.parse(index_schema.sql))
-                    assert isinstance(
-                        create_index, parser.CreateIndexStmt
-                    ), create_index
+                    create_index = compile_index_schema(str(index_schema.sql))
                     if (
-                        create_index.columns[0].text.casefold()
+                        create_index.columns[0].casefold()
                         == filter_column_name.casefold()
                     ):
                         break
@@ -177,14 +137,15 @@ def main():
                 )
 
             rows = read_table(
-                database_file,
-                db_config,
+                db,
                 table_info,
                 selected_columns,
                 where,
             )
 
-            if is_count_star:
+            if is_count_star and where is None:
+                print(count_table(db, table_info))
+            elif is_count_star:
                 i = -1
                 for i, _ in enumerate(rows):
                     pass
@@ -214,277 +175,951 @@ BTREE_PAGE_INTERIOR_TABLE = 0x05
 BTREE_PAGE_LEAF_INDEX = 0x0A
 BTREE_PAGE_LEAF_TABLE = 0x0D
 
+_BTREE_HEADER = struct.Struct(">BHHHB")
+# Interior pages' headers end with the right-most pointer
+_INTERIOR_BTREE_HEADER = struct.Struct(">BHHHBI")
+_U16 = struct.Struct(">H")
+_U32 = struct.Struct(">I")
+_F64 = struct.Struct(">d")
+
 
 def parse_btree_header(page, is_first_page=False):
     offset = 100 if is_first_page else 0
-    type_, first_freeblock, cell_count, cell_content_start, fragmented_free_bytes = (
-        struct.unpack_from(">BHHHB", page, offset)
-    )
-    if type_ in (BTREE_PAGE_INTERIOR_INDEX, BTREE_PAGE_INTERIOR_TABLE):
-        (rightmost_pointer,) = struct.unpack_from(">I", page, offset + 8)
-        bytes_read = 12
+    if page[offset] in (BTREE_PAGE_INTERIOR_INDEX, BTREE_PAGE_INTERIOR_TABLE):
+        (
+            type_,
+            first_freeblock,
+            cell_count,
+            cell_content_start,
+            fragmented_free_bytes,
+            rightmost_pointer,
+        ) = _INTERIOR_BTREE_HEADER.unpack_from(page, offset)
+        bytes_read = _INTERIOR_BTREE_HEADER.size
     else:
+        (
+            type_,
+            first_freeblock,
+            cell_count,
+            cell_content_start,
+            fragmented_free_bytes,
+        ) = _BTREE_HEADER.unpack_from(page, offset)
         rightmost_pointer = 0
-        bytes_read = 8
-    return BTreeHeader(
+        bytes_read = _BTREE_HEADER.size
+    header = BTreeHeader(
         type_,
         first_freeblock,
         cell_count,
+        # On 64 KiB pages, a cell content area starting at 65536 is stored as 0
         cell_content_start or 65536,
         fragmented_free_bytes,
         rightmost_pointer,
-    ), bytes_read
+    )
+    return header, bytes_read
 
 
 def parse_varint(buf, offset=0):
-    n = 0
-    for i in range(offset, offset + 9):
-        byte = buf[i]
-        n <<= 7
-        n |= byte & 0x7F
-        if byte & 0x80 == 0:
-            break
-    else:
-        i = -1
-    return n, i + 1 - offset
+    byte = buf[offset]
+    # Most varints (serial types, small rowids, header sizes) fit in one byte
+    if byte < 0x80:
+        return byte, 1
+
+    # Two-byte varints cover payload sizes and rowids up to 16383
+    n = byte & 0x7F
+    byte = buf[offset + 1]
+    if byte < 0x80:
+        return (n << 7) | byte, 2
+
+    # The rest is unrolled too, since setting up a loop over the remaining
+    # bytes costs about as much as decoding them
+    n = (n << 7) | (byte & 0x7F)
+    byte = buf[offset + 2]
+    n = (n << 7) | (byte & 0x7F)
+    if byte < 0x80:
+        return n, 3
+    byte = buf[offset + 3]
+    n = (n << 7) | (byte & 0x7F)
+    if byte < 0x80:
+        return n, 4
+    byte = buf[offset + 4]
+    n = (n << 7) | (byte & 0x7F)
+    if byte < 0x80:
+        return n, 5
+    byte = buf[offset + 5]
+    n = (n << 7) | (byte & 0x7F)
+    if byte < 0x80:
+        return n, 6
+    byte = buf[offset + 6]
+    n = (n << 7) | (byte & 0x7F)
+    if byte < 0x80:
+        return n, 7
+    byte = buf[offset + 7]
+    n = (n << 7) | (byte & 0x7F)
+    if byte < 0x80:
+        return n, 8
+
+    # Varints are at most 9 bytes (64 bits), the last of which contributes all
+    # 8 of its bits rather than 7. Only 9-byte varints can have the sign bit
+    # set, which negative rowids always do
+    n = (n << 8) | buf[offset + 8]
+    if n >= 1 << 63:
+        n -= 1 << 64
+    return n, 9
+
+
+# Sizes of the values of serial types 0-9, which are fixed by the type
+_FIXED_SIZES = (0, 1, 2, 3, 4, 6, 8, 8, 0, 0)
 
 
 def size_for_type(serial_type):
-    if serial_type < 5:
-        return serial_type
-    elif serial_type == 5:
-        return 6
-    elif 6 <= serial_type <= 7:
-        return 8
-    elif 8 <= serial_type <= 9:
-        return 0
-    elif serial_type >= 12 and serial_type % 2 == 0:
-        return (serial_type - 12) // 2
-    elif serial_type >= 13 and serial_type % 2 == 1:
-        return (serial_type - 13) // 2
+    if serial_type < 10:
+        return _FIXED_SIZES[serial_type]
+    elif serial_type >= 12:
+        # Blobs (even) and text (odd) both have a size of (N-12)/2 rounded down
+        return (serial_type - 12) >> 1
     else:
         raise NotImplementedError(serial_type)
 
 
-def parse_record(db_config, table_info, page, rowid, offset, selection, where):
-    initial_offset = offset
-    header_size, bytes_read = parse_varint(page, offset)
+# Sizes of the serial types that fit in a single-byte varint, for generated
+# code to look up. The reserved types 10 and 11 have no size, so using one of
+# those in arithmetic fails.
+_TYPE_SIZES = tuple(
+    None if serial_type in (10, 11) else size_for_type(serial_type)
+    for serial_type in range(0x80)
+)
+
+
+def _split_int_decoder(format, low_bits):
+    # struct has no 24- or 48-bit integers, so these are read as a signed high
+    # part, which takes care of the sign extension, and an unsigned low part
+    unpack_from = struct.Struct(format).unpack_from
+
+    def decode(page, offset):
+        high, low = unpack_from(page, offset)
+        return (high << low_bits) | low
+
+    return decode
+
+
+def _struct_decoder(format):
+    unpack_from = struct.Struct(format).unpack_from
+
+    def decode(page, offset):
+        return unpack_from(page, offset)[0]
+
+    return decode
+
+
+def _decode_null(_page, _offset):
+    return None
+
+
+def _decode_float(page, offset):
+    return _F64.unpack_from(page, offset)[0]
+
+
+def _decode_zero(_page, _offset):
+    return 0
+
+
+def _decode_one(_page, _offset):
+    return 1
+
+
+# Decoders for the fixed-size serial types 0-9, indexed by serial type. Types
+# 10 and 11 are reserved and rejected by size_for_type, and types 12 and up
+# are blobs and text whose size is encoded in the serial type itself.
+_SCALAR_DECODERS = [
+    _decode_null,
+    _struct_decoder(">b"),
+    _struct_decoder(">h"),
+    _split_int_decoder(">bH", 16),
+    _struct_decoder(">i"),
+    _split_int_decoder(">hI", 32),
+    _struct_decoder(">q"),
+    _decode_float,
+    _decode_zero,
+    _decode_one,
+]
+
+
+def parse_record_header(page, offset, column_limit):
+    # Headers are nearly always shorter than 128 bytes, so their size is a
+    # single-byte varint
+    header_size = page[offset]
+    if header_size < 0x80:
+        bytes_read = 1
+    else:
+        header_size, bytes_read = parse_varint(page, offset)
     header_end = offset + header_size
     offset += bytes_read
-    column_types = []
-    total_size = header_size
-    while offset != header_end:
-        column_serial_type, bytes_read = parse_varint(page, offset)
-        column_size = size_for_type(column_serial_type)
-        column_types.append((column_serial_type, column_size))
-        offset += bytes_read
-        total_size += column_size
+    # Alongside the serial types, the offset at which each column's value starts
+    # is computed, with one more for where the last value ends, so that the
+    # values can be read without walking through the columns before them.
+    # Columns past column_limit aren't needed, so the rest of the header is
+    # left unread.
+    serial_types = []
+    offsets = [header_end]
+    column_offset = header_end
+    for _ in range(column_limit):
+        if offset == header_end:
+            break
+        # Serial types for integers, floats, and short strings are single-byte
+        # varints, so decode those inline rather than calling parse_varint,
+        # and look their sizes up rather than calling size_for_type
+        column_serial_type = page[offset]
+        if column_serial_type < 0x80:
+            offset += 1
+            column_offset += _TYPE_SIZES[column_serial_type]
+        else:
+            column_serial_type, bytes_read = parse_varint(page, offset)
+            offset += bytes_read
+            column_offset += size_for_type(column_serial_type)
+        serial_types.append(column_serial_type)
+        offsets.append(column_offset)
+    return serial_types, offsets
+
+
+def record_parser(db, table_info, selection, where):
+    # Returns a function parsing a record into the values of the selected
+    # columns, or None if it doesn't match the WHERE clause. Once enough records
+    # have been parsed, they are decoded by code generated for this particular
+    # selection, see _compile_record_parsers and _compile_record_body.
+    return _record_parsers(db, table_info, selection, where)[0]
+
+
+def leaf_cells_parser(db, table_info, selection, where):
+    # Returns a generator function yielding the values of the selected columns
+    # of the rows in the given cells of a table leaf page that match the WHERE
+    # clause, which may be on the rowid. This is record_parser with the loop
+    # over the cells generated along with it, so that no function is called
+    # per row.
+    return _record_parsers(db, table_info, selection, where)[1]
+
+
+def _record_parsers(db, table_info, selection, where):
+    where_column = where.condition.lhs if where else None
+    where_value = where.condition.rhs if where else None
+    # Text in the database is compared with the WHERE value without decoding
+    # it, see _record_body_lines. A value that can't be encoded (e.g. one with
+    # undecodable bytes from argv escaped as surrogates) can't be equal to any
+    # text, so it's left as None, which no text compares equal to.
+    where_text = None
+    if isinstance(where_value, str):
+        try:
+            where_text = where_value.encode(db.text_encoding)
+        except UnicodeEncodeError:
+            pass
+    shape = (
+        tuple(selection),
+        where_column,
+        table_info.int_pk_column,
+        table_info.lazy_text_columns,
+        db.text_encoding,
+    )
+    # Only the header up to the last column that is used needs to be parsed
+    used_columns = [*selection] if where_column is None else [*selection, where_column]
+    column_limit = max(used_columns, default=-1) + 1
+    # Records usually all have the same number of columns, but those written
+    # before an ALTER TABLE ADD COLUMN will have fewer. As no more than
+    # column_limit columns are parsed, the bodies can be kept in a list indexed
+    # by column count rather than a dict.
+    bodies = [None] * (column_limit + 1)
+
+    def parse_any_record(page, rowid, offset):
+        serial_types, offsets = parse_record_header(page, offset, column_limit)
+        column_count = len(serial_types)
+        body = bodies[column_count]
+        if body is None:
+            body = bodies[column_count] = _compile_record_body(column_count, *shape)
+        return body(page, serial_types, offsets, rowid, where_value, where_text)
+
+    # Generating the code costs as much as decoding a few hundred records
+    # without it, which is more than most scans (and all schema scans) read. So
+    # records are decoded by _interpreted_record_parsers at first, and the code
+    # is only generated once RECORD_CODE_THRESHOLD records have been parsed.
+    interpreted = _interpreted_record_parsers(
+        column_limit, where_value, where_text, *shape
+    )
+    compiled = None
+    records_left = RECORD_CODE_THRESHOLD
+
+    def compile_parsers():
+        nonlocal compiled
+        make_parsers = _compile_record_parsers(column_limit, *shape)
+        compiled = make_parsers(parse_any_record, where_value, where_text)
+        return compiled
+
+    def parse_record(page, rowid, offset):
+        nonlocal records_left
+        if compiled is not None:
+            return compiled[0](page, rowid, offset)
+        records_left -= 1
+        if records_left < 0:
+            return compile_parsers()[0](page, rowid, offset)
+        return interpreted[0](page, rowid, offset)
+
+    def parse_leaf_cells(page, cell_pointers):
+        # Switches over a page at a time, so the generated loop is still the one
+        # that runs over each cell of the rest of a long scan
+        nonlocal records_left
+        if compiled is not None:
+            return compiled[1](page, cell_pointers)
+        records_left -= len(cell_pointers)
+        if records_left < 0:
+            return compile_parsers()[1](page, cell_pointers)
+        return interpreted[1](page, cell_pointers)
+
+    return parse_record, parse_leaf_cells
+
+
+def _record_body_lines(
+    column_count,
+    serial_type,
+    offset,
+    accept,
+    reject,
+    selection,
+    where_column,
+    int_pk_column,
+    lazy_text_columns,
+    text_encoding,
+):
+    # Generates straight-line code decoding exactly the columns needed by a
+    # query, reading each from its offset in the record. Serial types still
+    # vary from record to record (e.g. NULLs, integer widths, and text lengths)
+    # so they are dispatched on at runtime. serial_type and offset are formats
+    # for the expressions giving a column's serial type and offset by its index,
+    # and accept and reject the statements ending a record that does or doesn't
+    # match the WHERE clause.
+    column_selection = {column_id: order for order, column_id in enumerate(selection)}
+    wanted_columns = [
+        column_id
+        for column_id in range(column_count)
+        if column_id in column_selection or column_id == where_column
+    ]
+    # The WHERE column is decoded first, so that records that don't match are
+    # rejected before any of the selected columns are decoded
+    if where_column in wanted_columns:
+        wanted_columns.remove(where_column)
+        wanted_columns.insert(0, where_column)
+
+    # bytes.decode() without arguments takes a faster path straight to the
+    # UTF-8 decoder, which also has a fast path for ASCII text. UTF-16 has no
+    # such path and bytes.decode() would look the codec up by name every time,
+    # so its decoder function is called directly (final=True makes truncated
+    # text an error, as it is for bytes.decode())
+    if text_encoding == "utf-8":
+        decode_text = "blob_value.decode()"
+    else:
+        decode_text = '_decode_text(blob_value, "strict", True)[0]'
+
+    lines = [f"column_values = [None] * {len(selection)}"]
+    for column_id in wanted_columns:
+        end = offset.format(column_id + 1)
+        lines += [
+            f"column_serial_type = {serial_type.format(column_id)}",
+            f"offset = {offset.format(column_id)}",
+        ]
+        if column_id == int_pk_column:
+            decode_lines = [
+                "if column_serial_type == 0:",
+                "    value = rowid",
+                "elif column_serial_type < 10:",
+            ]
+        else:
+            decode_lines = ["if column_serial_type < 10:"]
+        decode_lines += [
+            "    value = _SCALAR_DECODERS[column_serial_type](page, offset)",
+            "elif column_serial_type & 1 == 0:",
+            f"    value = page[offset:{end}]",
+        ]
 
+        if column_id == where_column:
+            # Text is compared with the WHERE value encoded up front rather than
+            # decoded, and if they're equal the WHERE value is the text
+            lines += [
+                "if column_serial_type >= 13 and column_serial_type & 1:",
+                f"    if page[offset:{end}] != where_text:",
+                f"        {reject}",
+                "    value = where_value",
+                "else:",
+                *(f"    {line}" for line in decode_lines),
+                "    if value != where_value:",
+                f"        {reject}",
+            ]
+        elif column_id in lazy_text_columns:
+            lines += [
+                *decode_lines,
+                "else:",
+                f"    size = {end} - offset",
+                f"    value = LazyText(page, offset, size, {text_encoding!r})",
+            ]
+        else:
+            lines += [
+                *decode_lines,
+                "else:",
+                f"    blob_value = page[offset:{end}]",
+                "    try:",
+                f"        value = {decode_text}",
+                "    except UnicodeDecodeError:",
+                "        # FIXME: why does this happen?",
+                "        value = blob_value",
+            ]
+        if column_id in column_selection:
+            lines.append(f"column_values[{column_selection[column_id]}] = value")
+    lines.append(accept)
+    return lines
+
+
+def _exec_record_code(lines, name, text_encoding):
+    namespace = {
+        "_SCALAR_DECODERS": _SCALAR_DECODERS,
+        "_TYPE_SIZES": _TYPE_SIZES,
+        "LazyText": LazyText,
+        "parse_varint": parse_varint,
+        "_decode_text": _TEXT_DECODERS.get(text_encoding),
+    }
+    exec("\n".join(lines), namespace)
+    return namespace[name]
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_record_body(column_count, *shape):
+    # Decodes the body of a record whose header was parsed by
+    # parse_record_header, which works for any record
+    body_lines = _record_body_lines(
+        column_count,
+        "serial_types[{}]",
+        "offsets[{}]",
+        "return column_values",
+        "return None",
+        *shape,
+    )
+    lines = [
+        "def parse_record_body(",
+        "    page, serial_types, offsets, rowid, where_value, where_text",
+        "):",
+        *(f"    {line}" for line in body_lines),
+    ]
+    return _exec_record_code(lines, "parse_record_body", shape[-1])
+
+
+def _record_lines(column_limit, accept, reject, fallback, shape):
+    # Parses a whole record, header included, in straight-line code, keeping
+    # serial types and offsets in locals. This only works when the header has
+    # all of the columns used and they're single-byte varints, as is the case
+    # for all but records with long text or blobs (or missing columns), which
+    # are left to the fallback, parse_any_record.
+    lines = [
+        "header_size = page[offset]",
+        f"if header_size <= {column_limit} or header_size >= 0x80:",
+        *(f"    {line}" for line in fallback),
+    ]
+    if column_limit:
+        lines += [
+            *(f"t{i} = page[offset + {i + 1}]" for i in range(column_limit)),
+            f"if ({' | '.join(f't{i}' for i in range(column_limit))}) >= 0x80:",
+            *(f"    {line}" for line in fallback),
+        ]
+    lines += [
+        "o0 = offset + header_size",
+        *(f"o{i + 1} = o{i} + _TYPE_SIZES[t{i}]" for i in range(column_limit)),
+        *_record_body_lines(column_limit, "t{}", "o{}", accept, reject, *shape),
+    ]
+    return lines
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_record_parsers(column_limit, *shape):
+    where_column = shape[1]
+    record_lines = _record_lines(
+        column_limit,
+        "return column_values",
+        "return None",
+        ["return parse_any_record(page, rowid, offset)"],
+        shape,
+    )
+    cell_record_lines = _record_lines(
+        column_limit,
+        "yield column_values",
+        "continue",
+        [
+            "column_values = parse_any_record(page, rowid, offset)",
+            "if column_values is not None:",
+            "    yield column_values",
+            "continue",
+        ],
+        shape,
+    )
+    lines = [
+        "def make_parsers(parse_any_record, where_value, where_text):",
+        "    def parse_record(page, rowid, offset):",
+        *(f"        {line}" for line in record_lines),
+        "",
+        "    def parse_leaf_cells(page, cell_pointers):",
+        "        for offset in cell_pointers:",
+        # Calling parse_varint costs more than decoding the one- and two-byte
+        # varints that nearly all payload sizes and rowids fit in. The payload
+        # size itself isn't needed, since the record header says where each
+        # value ends, so it is only skipped over.
+        "            if page[offset] < 0x80:",
+        "                offset += 1",
+        "            elif page[offset + 1] < 0x80:",
+        "                offset += 2",
+        "            else:",
+        "                offset += parse_varint(page, offset)[1]",
+        "            rowid = page[offset]",
+        "            if rowid < 0x80:",
+        "                offset += 1",
+        "            elif page[offset + 1] < 0x80:",
+        "                rowid = ((rowid & 0x7F) << 7) | page[offset + 1]",
+        "                offset += 2",
+        "            else:",
+        "                rowid, bytes_read = parse_varint(page, offset)",
+        "                offset += bytes_read",
+    ]
+    if where_column == ROWID_COL_IDX:
+        lines += [
+            "            if rowid != where_value:",
+            "                continue",
+        ]
+    lines += [
+        *(f"            {line}" for line in cell_record_lines),
+        "",
+        "    return parse_record, parse_leaf_cells",
+    ]
+    return _exec_record_code(lines, "make_parsers", shape[-1])
+
+
+def _interpreted_record_parsers(
+    column_limit,
+    where_value,
+    where_text,
+    selection,
+    where_column,
+    int_pk_column,
+    lazy_text_columns,
+    text_encoding,
+):
+    # Decodes records the same way as the code generated by _record_lines and
+    # _record_body_lines, but by looping over the columns used, for scans that
+    # are too short for generating that code to pay off
     column_selection = {column_id: order for order, column_id in enumerate(selection)}
+    wanted_columns = sorted(
+        column_id
+        for column_id in {*selection, where_column}
+        if column_id is not None and column_id >= 0
+    )
+    if where_column in wanted_columns:
+        wanted_columns.remove(where_column)
+        wanted_columns.insert(0, where_column)
+
+    def parse_record(page, rowid, offset):
+        serial_types, offsets = parse_record_header(page, offset, column_limit)
+        column_count = len(serial_types)
+        column_values = [None] * len(selection)
+        for column_id in wanted_columns:
+            if column_id >= column_count:
+                continue
+            column_serial_type = serial_types[column_id]
+            offset = offsets[column_id]
+            end = offsets[column_id + 1]
+            if (
+                column_id == where_column
+                and column_serial_type >= 13
+                and column_serial_type & 1
+            ):
+                # As in the generated code, text is compared with the encoded
+                # WHERE value rather than decoded
+                if page[offset:end] != where_text:
+                    return None
+                value = where_value
+            else:
+                if column_serial_type == 0 and column_id == int_pk_column:
+                    value = rowid
+                elif column_serial_type < 10:
+                    value = _SCALAR_DECODERS[column_serial_type](page, offset)
+                elif column_serial_type & 1 == 0:
+                    value = page[offset:end]
+                elif column_id in lazy_text_columns:
+                    value = LazyText(page, offset, end - offset, text_encoding)
+                else:
+                    blob_value = page[offset:end]
+                    try:
+                        value = blob_value.decode(text_encoding)
+                    except UnicodeDecodeError:
+                        value = blob_value
+                if column_id == where_column and value != where_value:
+                    return None
+            if column_id in column_selection:
+                column_values[column_selection[column_id]] = value
+        return column_values
+
+    def parse_leaf_cells(page, cell_pointers):
+        for offset in cell_pointers:
+            # The payload size isn't needed, only skipped over
+            offset += parse_varint(page, offset)[1]
+            rowid, bytes_read = parse_varint(page, offset)
+            if where_column == ROWID_COL_IDX and rowid != where_value:
+                continue
+            column_values = parse_record(page, rowid, offset + bytes_read)
+            if column_values is not None:
+                yield column_values
 
-    column_values: list = [None] * len(column_selection)
-    for column_id, (column_serial_type, size) in enumerate(column_types):
-        if column_id not in column_selection and (
-            not where or column_id != where.condition.lhs
-        ):
-            offset += size
-            continue
+    return parse_record, parse_leaf_cells
 
-        if column_serial_type == 0:
-            if column_id == table_info.int_pk_column:
-                value = rowid
-            else:
-                value = None
-        elif 1 <= column_serial_type <= 6:
-            number_byte_size = (
-                column_serial_type
-                if column_serial_type < 5
-                else 6
-                if column_serial_type == 5
-                else 8
-            )
-            value = int.from_bytes(
-                page[offset : offset + number_byte_size], byteorder="big", signed=True
-            )
-        elif column_serial_type == 7:
-            value = struct.unpack_from(">d", page, offset)
-        elif column_serial_type in (8, 9):
-            value = int(column_serial_type == 9)
-        elif column_serial_type >= 12 and column_serial_type % 2 == 0:
-            value_len = (column_serial_type - 12) // 2
-            value = page[offset : offset + value_len]
-        elif column_serial_type >= 13 and column_serial_type % 2 == 1:
-            value_len = (column_serial_type - 13) // 2
-            blob_value = page[offset : offset + value_len]
-            try:
-                value = blob_value.decode(db_config.text_encoding)
-            except UnicodeDecodeError:
-                # FIXME: why does this happen?
-                value = blob_value
-        else:
-            raise NotImplementedError(column_serial_type)
 
-        offset += size
+class LazyText:
+    # Keeps a reference to the page rather than a copy of the text, so text
+    # that is never used isn't copied out of the page either
+    __slots__ = ("_page", "_offset", "_size", "_encoding", "_text")
 
-        if where and column_id == where.condition.lhs and value != where.condition.rhs:
-            return None, total_size
+    def __init__(self, page, offset, size, encoding):
+        self._page = page
+        self._offset = offset
+        self._size = size
+        self._encoding = encoding
+        self._text = None
 
-        if column_id in column_selection:
-            column_values[column_selection[column_id]] = value
+    def __str__(self):
+        if self._text is None:
+            raw = self._page[self._offset : self._offset + self._size]
+            self._text = raw.decode(self._encoding)
+            self._page = None
+        return self._text
 
-    return column_values, offset - initial_offset
+    def __repr__(self):
+        return repr(str(self))
 
+    def __eq__(self, other):
+        if isinstance(other, LazyText):
+            other = str(other)
+        return str(self) == other
 
-DBConfig = namedtuple("DBConfig", "page_size,text_encoding,page_reserved")
-TableInfo = namedtuple("TableInfo", "rootpage,int_pk_column")
+    def __hash__(self):
+        return hash(str(self))
+
+    def __getattr__(self, name):
+        return getattr(str(self), name)
+
+
+# Text in lazy_text_columns is decoded on first use rather than when the record
+# is read, for columns that are usually skipped over by the caller
+TableInfo = namedtuple(
+    "TableInfo",
+    "rootpage,int_pk_column,lazy_text_columns",
+    defaults=(frozenset(),),
+)
 BinOp = namedtuple("BinOp", "op,lhs,rhs")
 Where = namedtuple("Where", "condition,index_rootpage")
 ROWID_COL_IDX = -1
 
 
-def get_page(file, db_config, id_):
-    file.seek((id_ - 1) * db_config.page_size)
-    return file.read(db_config.page_size)
+TEXT_ENCODINGS = ["utf-8", "utf-16-le", "utf-16-be"]
+_TEXT_DECODERS = {
+    "utf-16-le": codecs.utf_16_le_decode,
+    "utf-16-be": codecs.utf_16_be_decode,
+}
+
+# How many records are decoded for a query shape before code is generated for
+# it, see _record_parsers
+RECORD_CODE_THRESHOLD = 500
+# How far apart an interior page's children can be spread, relative to how
+# many there are, for them to still be prefetched with a single hint
+PREFETCH_SPREAD = 2
+# How much of the file is read at once when it can't be memory-mapped. Pages
+# are at most this big, and as both are powers of two no page straddles blocks
+READ_AHEAD_SIZE = 65536
+# Not every platform has these (e.g. posix_fadvise on macOS)
+_MADV_WILLNEED = getattr(mmap, "MADV_WILLNEED", None)
+_POSIX_FADV_WILLNEED = getattr(os, "POSIX_FADV_WILLNEED", None)
+
+
+class Database:
+    # The database header is only read once, when the database is opened
+    __slots__ = (
+        "file",
+        "page_size",
+        "page_shift",
+        "page_reserved",
+        "text_encoding",
+        "pages",
+        "_schema_index",
+        "_window",
+        "_window_start",
+    )
+
+    def __init__(self, file):
+        self.file = file
+        self._schema_index = None
+        self._window = b""
+        self._window_start = 0
+        header = self.read(0, 100)
+        (page_size,) = _U16.unpack_from(header, 16)
+        # 65536 doesn't fit in the 2 bytes of the header, so it's stored as 1
+        self.page_size = 65536 if page_size == 1 else page_size
+        if not (
+            512 <= self.page_size <= 65536
+            and self.page_size & (self.page_size - 1) == 0
+        ):
+            raise ValueError(f"Invalid page size {self.page_size}")
+        self.page_shift = self.page_size.bit_length() - 1
+        self.page_reserved = header[20]
+        (text_encoding,) = _U32.unpack_from(header, 56)
+        self.text_encoding = TEXT_ENCODINGS[text_encoding - 1]
+        self.pages = PageCache(self)
+
+    def read(self, offset, size):
+        if isinstance(self.file, mmap.mmap):
+            # This copies the page, but a single memcpy is cheaper than handing
+            # out a memoryview: indexing and decoding through a view is slower
+            # for the many small reads done per page, and outstanding views
+            # would keep the mapping from being closed
+            return self.file[offset : offset + size]
+
+        # Without a mapping, the file is read READ_AHEAD_SIZE bytes at a time
+        # and reads are served from the last block read, so that a scan over
+        # neighbouring pages doesn't need a syscall for each one
+        start = offset - self._window_start
+        if start < 0 or start + size > len(self._window):
+            window_start = offset - offset % READ_AHEAD_SIZE
+            window_size = max(READ_AHEAD_SIZE, offset + size - window_start)
+            self._window = os.pread(self.file.fileno(), window_size, window_start)
+            self._window_start = window_start
+            start = offset - window_start
+        return self._window[start : start + size]
+
+    def prefetch(self, id_, count=1):
+        # Only a hint that the pages will be read soon, so that the OS can start
+        # reading them in while earlier pages are being parsed
+        offset = (id_ - 1) << self.page_shift
+        size = count << self.page_shift
+        if isinstance(self.file, mmap.mmap):
+            if _MADV_WILLNEED is not None:
+                # madvise needs an address aligned to the OS page size, and
+                # mustn't go past the end of the mapping
+                start = offset & -mmap.PAGESIZE
+                end = min(offset + size, len(self.file))
+                if start < end:
+                    self.file.madvise(_MADV_WILLNEED, start, end - start)
+        elif _POSIX_FADV_WILLNEED is not None:
+            os.posix_fadvise(self.file.fileno(), offset, size, _POSIX_FADV_WILLNEED)
+
+    @property
+    def schema_index(self):
+        # Built on first use, so only commands that look up tables pay for it
+        if self._schema_index is None:
+            self._schema_index = index_sqlite_schema(self)
+        return self._schema_index
+
+
+class PageCache:
+    # Pages near the root of a B-tree are read again each time the same table
+    # is searched (the schema page, for one, is read to find the table and
+    # again by queries on it), so recently used pages are kept around. Pages
+    # move to the end of the dict when used, so the first is the least recent
+    __slots__ = ("_db", "_pages", "_maxsize")
+
+    def __init__(self, db, maxsize=100):
+        self._db = db
+        self._pages = {}
+        self._maxsize = maxsize
+
+    def __call__(self, id_):
+        pages = self._pages
+        page = pages.pop(id_, None)
+        if page is None:
+            db = self._db
+            page = db.read((id_ - 1) << db.page_shift, db.page_size)
+            if len(pages) >= self._maxsize:
+                del pages[next(iter(pages))]
+        pages[id_] = page
+        return page
+
+
+@contextlib.contextmanager
+def open_database(path):
+    with open(path, "rb") as file:
+        # Pages are sliced straight out of a read-only mapping of the file, so
+        # reading one doesn't cost a seek and a read syscall each time
+        try:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Some files (e.g. on filesystems without mmap support) can't be
+            # mapped, in which case pages are read with pread instead. That
+            # still needs a seekable file, so pipes aren't supported
+            mapping = None
+
+        if mapping is None:
+            yield Database(file)
+        else:
+            with mapping:
+                yield Database(mapping)
+
 
+def get_page(db, id_):
+    return db.pages(id_)
 
-def read_table(file, db_config, table_info, selection, where):
+
+def read_cell_pointers(page, offset, cell_count):
+    # Copying the whole big-endian array and byte-swapping it in place is much
+    # faster than unpacking pointers one by one once a page has a few dozen
+    cell_pointers = array.array("H", page[offset : offset + 2 * cell_count])
+    if sys.byteorder == "little":
+        cell_pointers.byteswap()
+    return cell_pointers
+
+
+def read_table(db, table_info, selection, where):
     if where and where.index_rootpage:
-        matching_ids = list(
-            _read_index(file, db_config, table_info, where.index_rootpage, where)
-        )
-        page = get_page(file, db_config, table_info.rootpage)
+        parse_key = record_parser(db, table_info, [0, 1], None)
+        matching_ids = list(_read_index(db, parse_key, where.index_rootpage, where))
+        page = get_page(db, table_info.rootpage)
         yield from _read_table_by_id(
-            file,
-            db_config,
+            db,
             table_info,
             page,
-            selection,
+            record_parser(db, table_info, selection, None),
             (min(matching_ids), max(matching_ids)),
             set(matching_ids),
         )
     else:
-        page = get_page(file, db_config, table_info.rootpage)
-        yield from _read_table(file, db_config, table_info, page, selection, where)
+        parse_leaf_cells = leaf_cells_parser(db, table_info, selection, where)
+        yield from _read_table(db, table_info, parse_leaf_cells)
 
 
-def _read_table(file, db_config, table_info, page, selection, where):
-    btree_header, bytes_read = parse_btree_header(
-        page, is_first_page=table_info.rootpage == 1
-    )
+def _read_table(db, table_info, parse_leaf_cells):
+    # The B-tree is walked depth-first with a stack of the pages still to be
+    # read, the next one last, rather than by recursing into each child (every
+    # row would then be passed up through a generator per level of the tree)
+    stack = [table_info.rootpage]
+    # Pages smaller than the OS page would have several consecutive hints land
+    # on the same OS page, so they aren't prefetched at all
+    prefetch = db.page_size >= mmap.PAGESIZE
+    while stack:
+        page_id = stack.pop()
+        page = get_page(db, page_id)
 
-    btree_offset = bytes_read
-    if table_info.rootpage == 1:
-        btree_offset += 100
+        btree_header, bytes_read = parse_btree_header(page, is_first_page=page_id == 1)
+
+        btree_offset = bytes_read
+        if page_id == 1:
+            btree_offset += 100
 
-    for i in range(btree_header.cell_count):
-        (cell_content_offset,) = struct.unpack_from(">H", page, btree_offset + 2 * i)
+        cell_pointers = read_cell_pointers(page, btree_offset, btree_header.cell_count)
 
         if btree_header.type == BTREE_PAGE_INTERIOR_TABLE:
-            (left_ptr,) = struct.unpack_from(">I", page, cell_content_offset)
-            left_page = get_page(file, db_config, left_ptr)
-            yield from _read_table(
-                file, db_config, table_info, left_page, selection, where
-            )
-        else:
-            assert btree_header.type == BTREE_PAGE_LEAF_TABLE
-            payload_size, bytes_read = parse_varint(page, cell_content_offset)
-            cell_content_offset += bytes_read
+            child_ids = [
+                _U32.unpack_from(page, cell_content_offset)[0]
+                for cell_content_offset in cell_pointers
+            ]
+            child_ids.append(btree_header.rightmost_pointer)
+            child_ids.reverse()
+            stack += child_ids
+
+            # The children are read in while the first ones are parsed, with a
+            # single hint for all of them as long as they are mostly next to
+            # each other in the file (as they usually are)
+            if prefetch:
+                first_id = min(child_ids)
+                count = max(child_ids) - first_id + 1
+                if count <= PREFETCH_SPREAD * len(child_ids):
+                    db.prefetch(first_id, count)
+            continue
 
-            rowid, bytes_read = parse_varint(page, cell_content_offset)
-            cell_content_offset += bytes_read
+        assert btree_header.type == BTREE_PAGE_LEAF_TABLE
+        yield from parse_leaf_cells(page, cell_pointers)
 
-            if (
-                where
-                and where.condition.op == "="
-                and where.condition.lhs == ROWID_COL_IDX
-                and rowid != where.condition.rhs
-            ):
-                column_values = None
-            else:
-                column_values, bytes_read = parse_record(
-                    db_config,
-                    table_info,
-                    page,
-                    rowid,
-                    cell_content_offset,
-                    selection,
-                    where,
-                )
-                assert bytes_read == payload_size, (bytes_read, payload_size)
 
-            # filtered out
-            if column_values is None:
-                continue
+def count_table(db, table_info):
+    # Every cell of a leaf page is a row, so without a WHERE clause the rows
+    # can be counted without parsing any of them
+    count = 0
+    stack = [table_info.rootpage]
+    while stack:
+        page_id = stack.pop()
+        page = get_page(db, page_id)
+        btree_header, bytes_read = parse_btree_header(page, is_first_page=page_id == 1)
 
-            yield column_values
+        if btree_header.type == BTREE_PAGE_LEAF_TABLE:
+            count += btree_header.cell_count
+            continue
 
-    if btree_header.type == BTREE_PAGE_INTERIOR_TABLE:
-        rightmost_page = get_page(file, db_config, btree_header.rightmost_pointer)
-        yield from _read_table(
-            file, db_config, table_info, rightmost_page, selection, where
-        )
+        assert btree_header.type == BTREE_PAGE_INTERIOR_TABLE
+        btree_offset = bytes_read
+        if page_id == 1:
+            btree_offset += 100
+        for cell_content_offset in read_cell_pointers(
+            page, btree_offset, btree_header.cell_count
+        ):
+            stack.append(_U32.unpack_from(page, cell_content_offset)[0])
+        stack.append(btree_header.rightmost_pointer)
 
+    return count
 
-def _read_index(file, db_config, table_info, page_id, where):
-    page = get_page(file, db_config, page_id)
-    btree_header, cell_array_offset = parse_btree_header(page)
-    is_leaf = btree_header.type == BTREE_PAGE_LEAF_INDEX
-    assert is_leaf or btree_header.type == BTREE_PAGE_INTERIOR_INDEX
 
-    def _read_key(cell_content_offset):
+def _read_index(db, parse_key, rootpage, where):
+    def _read_key(page, is_leaf, cell_content_offset):
         if not is_leaf:
-            (left_pointer,) = struct.unpack_from(">I", page, cell_content_offset)
-            cell_content_offset += 4
+            (left_pointer,) = _U32.unpack_from(page, cell_content_offset)
+            cell_content_offset += _U32.size
         else:
             left_pointer = None
 
-        payload_size, bytes_read = parse_varint(page, cell_content_offset)
-        cell_content_offset += bytes_read
-        index_data, bytes_read = parse_record(
-            db_config, table_info, page, None, cell_content_offset, [0, 1], None
-        )
-        assert bytes_read == payload_size
+        # The payload size isn't needed, only skipped over
+        if page[cell_content_offset] < 0x80:
+            cell_content_offset += 1
+        else:
+            cell_content_offset += parse_varint(page, cell_content_offset)[1]
+        index_data = parse_key(page, None, cell_content_offset)
         assert index_data is not None
         return index_data, left_pointer
 
-    L = 0
-    R = btree_header.cell_count
-    while L < R:
-        i = (L + R) // 2
+    key = where.condition.rhs
 
-        (cell_content_offset,) = struct.unpack_from(
-            ">H", page, cell_array_offset + 2 * i
-        )
-        index_data, left_pointer = _read_key(cell_content_offset)
+    # Like _read_table, the pages still to be searched are kept on a stack
+    stack = [rootpage]
+    while stack:
+        page = get_page(db, stack.pop())
+        btree_header, cell_array_offset = parse_btree_header(page)
+        is_leaf = btree_header.type == BTREE_PAGE_LEAF_INDEX
+        assert is_leaf or btree_header.type == BTREE_PAGE_INTERIOR_INDEX
 
-        if index_data[0] < where.condition.rhs:
-            L = i + 1
-        else:
-            R = i
+        cell_pointers = read_cell_pointers(
+            page, cell_array_offset, btree_header.cell_count
+        )
 
-    for i in range(L, btree_header.cell_count):
-        (cell_content_offset,) = struct.unpack_from(
-            ">H", page, cell_array_offset + 2 * i
+        # The first cell whose key isn't less than the one searched for
+        L = bisect.bisect_left(
+            range(btree_header.cell_count),
+            key,
+            key=lambda i: _read_key(page, is_leaf, cell_pointers[i])[0][0],
         )
-        index_data, left_pointer = _read_key(cell_content_offset)
 
-        if not is_leaf:
-            assert left_pointer is not None
-            yield from _read_index(file, db_config, table_info, left_pointer, where)
+        child_ids = []
+        for i in range(L, btree_header.cell_count):
+            cell_content_offset = cell_pointers[i]
+            index_data, left_pointer = _read_key(page, is_leaf, cell_content_offset)
 
-        if index_data[0] == where.condition.rhs:
-            yield index_data[1]
+            if not is_leaf:
+                assert left_pointer is not None
+                child_ids.append(left_pointer)
 
-        if index_data[0] > where.condition.rhs:
-            break
-    else:
-        if not is_leaf:
-            yield from _read_index(
-                file, db_config, table_info, btree_header.rightmost_pointer, where
-            )
+            if index_data[0] == key:
+                yield index_data[1]
+
+            if index_data[0] > key:
+                break
+        else:
+            if not is_leaf:
+                child_ids.append(btree_header.rightmost_pointer)
 
+        child_ids.reverse()
+        stack += child_ids
 
-def _read_table_by_id(file, db_config, table_info, page, selection, id_range, ids):
+
+def _read_table_by_id(db, table_info, page, parse_record, id_range, ids):
     btree_header, bytes_read = parse_btree_header(
         page, is_first_page=table_info.rootpage == 1
     )
@@ -495,80 +1130,149 @@ def _read_table_by_id(file, db_config, table_info, page, selection, id_range, id
     if table_info.rootpage == 1:
         btree_offset += 100
 
-    L = 0
-    R = btree_header.cell_count
-    while L < R:
-        i = (L + R) // 2
-
-        (cell_content_offset,) = struct.unpack_from(">H", page, btree_offset + 2 * i)
+    cell_pointers = read_cell_pointers(page, btree_offset, btree_header.cell_count)
+    min_id, max_id = id_range
 
+    def _read_rowid(i):
+        cell_content_offset = cell_pointers[i]
         if is_leaf:
             _payload_size, bytes_read = parse_varint(page, cell_content_offset)
             cell_content_offset += bytes_read
-            rowid, bytes_read = parse_varint(page, cell_content_offset)
-            cell_content_offset += bytes_read
         else:
-            rowid, bytes_read = parse_varint(page, cell_content_offset + 4)
+            cell_content_offset += _U32.size
+        return parse_varint(page, cell_content_offset)[0]
 
-        if rowid < id_range[0]:
-            L = i + 1
-        else:
-            R = i
+    # The first cell whose rowid isn't less than the smallest one wanted
+    L = bisect.bisect_left(range(btree_header.cell_count), min_id, key=_read_rowid)
 
     for i in range(L, btree_header.cell_count):
-        (cell_content_offset,) = struct.unpack_from(">H", page, btree_offset + 2 * i)
+        cell_content_offset = cell_pointers[i]
 
         if not is_leaf:
-            (left_ptr,) = struct.unpack_from(">I", page, cell_content_offset)
-            left_page = get_page(file, db_config, left_ptr)
+            (left_ptr,) = _U32.unpack_from(page, cell_content_offset)
+            left_page = get_page(db, left_ptr)
             yield from _read_table_by_id(
-                file, db_config, table_info, left_page, selection, id_range, ids
+                db, table_info, left_page, parse_record, id_range, ids
             )
         else:
-            payload_size, bytes_read = parse_varint(page, cell_content_offset)
-            cell_content_offset += bytes_read
+            # As in the generated leaf loop, short varints are decoded inline
+            # and the payload size is only skipped over
+            if page[cell_content_offset] < 0x80:
+                cell_content_offset += 1
+            else:
+                cell_content_offset += parse_varint(page, cell_content_offset)[1]
 
-            rowid, bytes_read = parse_varint(page, cell_content_offset)
-            cell_content_offset += bytes_read
+            rowid = page[cell_content_offset]
+            if rowid < 0x80:
+                cell_content_offset += 1
+            else:
+                rowid, bytes_read = parse_varint(page, cell_content_offset)
+                cell_content_offset += bytes_read
 
             if rowid not in ids:
                 column_values = None
             else:
-                column_values, bytes_read = parse_record(
-                    db_config,
-                    table_info,
-                    page,
-                    rowid,
-                    cell_content_offset,
-                    selection,
-                    None,
-                )
-                assert bytes_read == payload_size, (bytes_read, payload_size)
+                column_values = parse_record(page, rowid, cell_content_offset)
 
             # filtered out
             if column_values is not None:
                 yield column_values
 
-            if rowid >= id_range[1]:
+            if rowid >= max_id:
                 break
     else:
         if not is_leaf:
-            rightmost_page = get_page(file, db_config, btree_header.rightmost_pointer)
+            rightmost_page = get_page(db, btree_header.rightmost_pointer)
             yield from _read_table_by_id(
-                file, db_config, table_info, rightmost_page, selection, id_range, ids
+                db, table_info, rightmost_page, parse_record, id_range, ids
             )
 
 
-SqliteSchema = namedtuple(
-    "SqliteSchema", ["type", "name", "tbl_name", "rootpage", "sql"]
+SQLITE_SCHEMA_COLUMNS = ("type", "name", "tbl_name", "rootpage", "sql")
+SqliteSchema = namedtuple("SqliteSchema", SQLITE_SCHEMA_COLUMNS)
+
+
+# Only the few schema rows for the table being queried need their sql parsed
+_SQLITE_SCHEMA_TABLE_INFO = TableInfo(
+    1, None, lazy_text_columns=frozenset({SQLITE_SCHEMA_COLUMNS.index("sql")})
 )
 
 
-def select_all_from_sqlite_schema(file, db_config):
-    for column_values in read_table(
-        file, db_config, TableInfo(1, None), list(range(5)), None
-    ):
-        yield SqliteSchema(*column_values)
+def select_all_from_sqlite_schema(db, columns=SQLITE_SCHEMA_COLUMNS, type_=None):
+    # Columns that aren't asked for are left as None without being decoded.
+    # Rows can be filtered by type, which is checked before anything else in
+    # the row is decoded.
+    selection = [SQLITE_SCHEMA_COLUMNS.index(column) for column in columns]
+    is_full_row = selection == list(range(len(SQLITE_SCHEMA_COLUMNS)))
+    where = None
+    if type_ is not None:
+        where = Where(BinOp("=", SQLITE_SCHEMA_COLUMNS.index("type"), type_), None)
+    for column_values in read_table(db, _SQLITE_SCHEMA_TABLE_INFO, selection, where):
+        if is_full_row:
+            yield SqliteSchema(*column_values)
+            continue
+
+        row = [None] * len(SQLITE_SCHEMA_COLUMNS)
+        for column_id, value in zip(selection, column_values):
+            row[column_id] = value
+        yield SqliteSchema(*row)
+
+
+TableSchema = namedtuple("TableSchema", "table,indexes")
+
+
+def index_sqlite_schema(db):
+    # Maps each table's casefolded name to its schema row and those of its
+    # indexes
+    tables = {}
+    indexes = {}
+    for row in select_all_from_sqlite_schema(db):
+        table_name = row.tbl_name.casefold()
+        if row.type == "table":
+            tables[table_name] = row
+        elif row.type == "index":
+            indexes.setdefault(table_name, []).append(row)
+
+    return {
+        table_name: TableSchema(table, indexes.get(table_name, []))
+        for table_name, table in tables.items()
+    }
+
+
+# The parsed schema of a table only depends on its SQL, so it only needs to be
+# worked out once however many times the table is queried. The results are
+# shared between callers, so column_order is a read-only view of the mapping.
+@functools.lru_cache(maxsize=64)
+def compile_table_schema(sql):
+    create_table_ast = parser.parse_cached(sql)[0]
+    assert isinstance(create_table_ast, parser.CreateTableStmt)
+
+    column_order = {
+        name.casefold(): i for i, (name, _type) in enumerate(create_table_ast.columns)
+    }
+    column_order["rowid".casefold()] = ROWID_COL_IDX
+
+    primary_key_column_idx = next(
+        (
+            column_index
+            for column_index, column in enumerate(create_table_ast.columns)
+            if column.type.casefold().startswith("integer primary key".casefold())
+        ),
+        None,
+    )
+
+    return (
+        create_table_ast,
+        types.MappingProxyType(column_order),
+        primary_key_column_idx,
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def compile_index_schema(sql):
+    create_index = parser.parse_cached(sql)[0]
+    assert isinstance(create_index, parser.CreateIndexStmt), create_index
+    return create_index
 
 
 if __name__ == "__main__":
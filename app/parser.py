@@ -1,107 +1,186 @@
+import functools
 from collections import namedtuple
 
-Token = namedtuple("Token", "type,text")
-_NOTHING = object()
+# Tokens are plain (type, text) tuples, with types being small ints that are
+# named by TOKEN_TYPES
+TOKEN_TYPES = (
+    "COMMA",
+    "LPAREN",
+    "RPAREN",
+    "SEMICOLON",
+    "STAR",
+    "EQUAL",
+    "SELECT",
+    "FROM",
+    "WHERE",
+    "CREATE",
+    "TABLE",
+    "INDEX",
+    "ON",
+    "NAME",
+    "STRING",
+    "EOF",
+)
+(
+    COMMA,
+    LPAREN,
+    RPAREN,
+    SEMICOLON,
+    STAR,
+    EQUAL,
+    SELECT,
+    FROM,
+    WHERE,
+    CREATE,
+    TABLE,
+    INDEX,
+    ON,
+    NAME,
+    STRING,
+    EOF,
+) = range(len(TOKEN_TYPES))
 
 
 class ParseError(Exception):
     pass
 
 
-class _peekable:
-    def __init__(self, it):
-        self._it = it
-        self._peeked = _NOTHING
+# Tokens never change, so punctuation is scanned into these shared ones
+# rather than into a new tuple for each occurrence
+_one_char_tokens = {
+    ",": (COMMA, ","),
+    "(": (LPAREN, "("),
+    ")": (RPAREN, ")"),
+    ";": (SEMICOLON, ";"),
+    "*": (STAR, "*"),
+    "=": (EQUAL, "="),
+}
 
-    def __next__(self):
-        if self._peeked is not _NOTHING:
-            val = self._peeked
-            self._peeked = _NOTHING
-            return val
-        return next(self._it)
+_keywords = {
+    "SELECT": SELECT,
+    "FROM": FROM,
+    "WHERE": WHERE,
+    "CREATE": CREATE,
+    "TABLE": TABLE,
+    "INDEX": INDEX,
+    "ON": ON,
+}
+_MAX_KEYWORD_LENGTH = max(map(len, _keywords))
 
-    def peek(self):
-        if self._peeked is _NOTHING:
-            try:
-                self._peeked = next(self._it)
-            except StopIteration:
-                self._peeked = None
-        return self._peeked
 
+_WHITESPACE, _PUNCTUATION, _NAME_START, _QUOTE, _OTHER, _REPLACED = range(6)
 
-def scan(text):
-    yield from _scan(_peekable(iter(text)))
 
+def _char_class(c):
+    if c.isspace():
+        return _WHITESPACE
+    elif c in _one_char_tokens:
+        return _PUNCTUATION
+    elif c.isalpha():
+        return _NAME_START
+    elif c in ("'", '"'):
+        return _QUOTE
+    return _OTHER
 
-_one_char_tokens = {
-    ",": "COMMA",
-    "(": "LPAREN",
-    ")": "RPAREN",
-    ";": "SEMICOLON",
-    "*": "STAR",
-    "=": "EQUAL",
-}
-
-_keywords = {
-    "SELECT".casefold(): "SELECT",
-    "FROM".casefold(): "FROM",
-    "WHERE".casefold(): "WHERE",
-    "CREATE".casefold(): "CREATE",
-    "TABLE".casefold(): "TABLE",
-    "INDEX".casefold(): "INDEX",
-    "ON".casefold(): "ON",
-}
 
+# The scanner classifies characters by their ASCII code, so that it only
+# needs the predicates above for characters that aren't ASCII. Those are
+# encoded as "?", which has its own class to have it look at the original
+_REPLACEMENT = ord("?")
+_ASCII_CHAR_CLASSES = [
+    _REPLACED if i == _REPLACEMENT else _char_class(chr(i)) for i in range(128)
+]
+_ASCII_NAME_CHARS = [c.isalnum() or c == "_" for c in map(chr, range(128))]
 
-def _scan(it):
-    while True:
-        c = next(it, None)
-        if c is None:
-            break
 
-        if c.isspace():
+def scan(text):
+    # Scan by index over the string itself, slicing tokens out of it rather
+    # than building them up a character at a time. Encoding with replacement
+    # keeps one byte per character, so positions are the same in both
+    codes = text.encode("ascii", "replace")
+    pos = 0
+    n = len(text)
+    while pos < n:
+        char_class = _ASCII_CHAR_CLASSES[codes[pos]]
+        if char_class == _REPLACED:
+            char_class = _char_class(text[pos])
+        pos += 1
+
+        if char_class == _WHITESPACE:
             continue
-        elif c in _one_char_tokens:
-            yield Token(_one_char_tokens[c], c)
-        elif c.isalpha():
-            name = c
-            while it.peek() is not None and (it.peek().isalnum() or it.peek() == "_"):
-                name += next(it)
-            if name.casefold() in _keywords:
-                yield Token(_keywords[name.casefold()], name)
+        elif char_class == _PUNCTUATION:
+            yield _one_char_tokens[text[pos - 1]]
+        elif char_class == _NAME_START:
+            start = pos - 1
+            while pos < n and (
+                _ASCII_NAME_CHARS[codes[pos]]
+                or (codes[pos] == _REPLACEMENT and text[pos].isalnum())
+            ):
+                pos += 1
+            name = text[start:pos]
+            # Keywords are all ASCII, but str.upper() maps some other letters
+            # onto ASCII ones (e.g. dotless "ı" onto "I"), so other names are
+            # never keywords
+            if pos - start <= _MAX_KEYWORD_LENGTH and name.isascii():
+                yield _keywords.get(name.upper(), NAME), name
             else:
-                yield Token("NAME", name)
-        elif c in ("'", '"'):
-            terminator = c
-            str_content = ""
+                yield NAME, name
+        elif char_class == _QUOTE:
+            c = terminator = text[pos - 1]
+            parts = []
             while True:
-                c = next(it, None)
-                if c is None:
+                end = text.find(terminator, pos)
+                if end == -1:
                     raise ParseError("Unterminated string literal")
-                if c == terminator:
-                    if it.peek() == terminator:
-                        str_content += terminator
-                    else:
-                        break
+                parts.append(text[pos:end])
+                pos = end + 1
+                # A doubled terminator is an escaped one
+                if text.startswith(terminator, pos):
+                    parts.append(terminator)
+                    pos += 1
                 else:
-                    str_content += c
-            yield Token("STRING" if c == "'" else "NAME", str_content)
+                    break
+            yield STRING if c == "'" else NAME, "".join(parts)
         else:
-            raise ParseError(f"Unexpected token {c!r}")
+            raise ParseError(f"Unexpected token {text[pos - 1]!r}")
+
+
+def _expect(tokens, pos, ty):
+    # Returns the text of the expected token and the position after it
+    tok = tokens[pos]
+    if tok[0] != ty:
+        got = "end of input" if tok[0] == EOF else TOKEN_TYPES[tok[0]]
+        raise ParseError(f"Expected {TOKEN_TYPES[ty]}, got {got}")
+    return tok[1], pos + 1
+
 
+def _describe(tok):
+    if tok[0] == EOF:
+        return "end of input"
+    return f"{TOKEN_TYPES[tok[0]]} {tok[1]!r}"
 
-def _expect(it, ty):
-    try:
-        tok = next(it)
-    except StopIteration:
-        raise ParseError(f"Expected {ty}, got end of input")
-    if tok.type != ty:
-        raise ParseError(f"Expected {ty}, got {tok.type}")
-    return tok
+
+_EOF_TOKEN = (EOF, "")
 
 
 def parse(text):
-    yield from _parse(_peekable(scan(text)))
+    # The parser walks a list of tokens by index; each _parse_* function takes
+    # the position to start at and returns the position after what it parsed.
+    # The tokens end with an EOF token, so the parser can always look at the
+    # token at its position without checking for the end first
+    tokens = [*scan(text), _EOF_TOKEN]
+    stmt, pos = _parse(tokens, 0)
+    yield stmt
+
+    if tokens[pos][0] != EOF:
+        raise ParseError(f"Trailing characters after query: {_describe(tokens[pos])}")
+
+
+@functools.lru_cache(maxsize=256)
+def parse_cached(text):
+    # Statements are immutable, so the same text can share them between
+    # parses
+    return tuple(parse(text))
 
 
 SelectStmt = namedtuple("SelectStmt", "selects,from_table,where")
@@ -114,151 +193,172 @@ StarExpr = namedtuple("StarExpr", "")
 BinaryExpr = namedtuple("BinaryExpr", "op,lhs,rhs")
 StringExpr = namedtuple("StringExpr", "text")
 
+# Expressions are immutable, so the common ones are shared between parses
+# rather than built again each time
+_name_expr = functools.lru_cache(maxsize=4096)(NameExpr)
+_string_expr = functools.lru_cache(maxsize=1024)(StringExpr)
+_STAR_EXPR = StarExpr()
 
-def _parse(it):
-    if it.peek() and it.peek().type == "SELECT":
-        yield _parse_select_stmt(it)
-    elif it.peek() and it.peek().type == "CREATE":
-        yield _parse_create(it)
+
+def _parse(tokens, pos):
+    if tokens[pos][0] == SELECT:
+        return _parse_select_stmt(tokens, pos)
+    elif tokens[pos][0] == CREATE:
+        return _parse_create(tokens, pos)
     else:
-        raise ParseError(f"Unexpected token {it.peek()!r}")
+        raise ParseError(f"Unexpected {_describe(tokens[pos])}")
+
 
-    if it.peek() is not None:
-        raise ParseError(f"Trailing characters after query: {it.peek()!r}")
+def _parse_end(tokens, pos):
+    # Allows either the end of input or a semicolon, which is consumed
+    if tokens[pos][0] == SEMICOLON:
+        pos += 1
+    elif tokens[pos][0] != EOF:
+        raise ParseError(f"Expected end of input or semicolon, got {tokens[pos][1]!r}")
+    return pos
 
 
-def _parse_select_stmt(it):
-    _expect(it, "SELECT")
+def _parse_select_stmt(tokens, pos):
+    _, pos = _expect(tokens, pos, SELECT)
 
     selects = []
     first = True
-    while it.peek() and it.peek().type != "FROM":
+    while tokens[pos][0] not in (FROM, EOF):
         if first:
             first = False
         else:
-            _expect(it, "COMMA")
-        selects.append(_parse_selection(it))
+            _, pos = _expect(tokens, pos, COMMA)
+        selection, pos = _parse_selection(tokens, pos)
+        selects.append(selection)
 
-    _expect(it, "FROM")
+    _, pos = _expect(tokens, pos, FROM)
 
-    from_table = _expect(it, "NAME")
+    from_table, pos = _expect(tokens, pos, NAME)
 
-    tok = next(it, None)
     where = None
-    if tok and tok.type == "WHERE":
+    if tokens[pos][0] == WHERE:
         # FIXME: proper expression parsing
-        lhs = next(it, None)
-        op = next(it, None)
-        rhs = next(it, None)
-        if (
-            lhs is None
-            or op is None
-            or rhs is None
-            or lhs.type != "NAME"
-            or op.type != "EQUAL"
-            or rhs.type != "STRING"
-        ):
+        clause = tokens[pos + 1 : pos + 4]
+        if [ty for ty, _ in clause] != [NAME, EQUAL, STRING]:
             raise ParseError("Unsupported WHERE clause")
-        where = BinaryExpr(op.type, NameExpr(lhs.text), StringExpr(rhs.text))
-    elif tok and tok.type != "SEMICOLON":
-        raise ParseError(f"Expected end of input or semicolon, got {tok.text!r}")
-
-    return SelectStmt(selects, from_table.text, where)
-
+        (_, lhs), _, (_, rhs) = clause
+        where = BinaryExpr("EQUAL", _name_expr(lhs), _string_expr(rhs))
+        pos += 4
 
-def _parse_selection(it):
-    name = next(it, None)
-    if not name or name.type not in ("NAME", "STAR"):
-        raise ParseError(f"Expected name or '*', got {name!r}")
+    pos = _parse_end(tokens, pos)
 
-    if name.type == "STAR":
-        return StarExpr()
+    return SelectStmt(tuple(selects), from_table, where), pos
 
-    if not it.peek() or it.peek().type != "LPAREN":
-        return NameExpr(name.text)
 
-    args = []
-    first = True
-    next(it)
-    while it.peek() and it.peek().type != "RPAREN":
-        if first:
-            first = False
+def _parse_selection(tokens, pos):
+    # Function calls are parsed without recursing, keeping the calls that are
+    # still open on a stack along with the arguments parsed so far
+    stack = []
+    while True:
+        tok = tokens[pos]
+        if tok[0] not in (NAME, STAR):
+            raise ParseError(f"Expected name or '*', got {_describe(tok)}")
+        pos += 1
+
+        if tok[0] == STAR:
+            expr = _STAR_EXPR
+        elif tokens[pos][0] == LPAREN:
+            pos += 1
+            if tokens[pos][0] not in (RPAREN, EOF):
+                stack.append((tok[1].upper(), []))
+                continue
+            _, pos = _expect(tokens, pos, RPAREN)
+            expr = FunctionExpr(tok[1].upper(), ())
         else:
-            _expect(it, "COMMA")
-        args.append(_parse_selection(it))
-
-    _expect(it, "RPAREN")
-
-    return FunctionExpr(name.text.upper(), args)
+            expr = _name_expr(tok[1])
+
+        while stack:
+            name, args = stack[-1]
+            args.append(expr)
+            if tokens[pos][0] not in (RPAREN, EOF):
+                _, pos = _expect(tokens, pos, COMMA)
+                break
+            _, pos = _expect(tokens, pos, RPAREN)
+            stack.pop()
+            expr = FunctionExpr(name, tuple(args))
+        else:
+            return expr, pos
 
 
-def _parse_create(it):
-    _expect(it, "CREATE")
+def _parse_create(tokens, pos):
+    _, pos = _expect(tokens, pos, CREATE)
 
-    next_ = it.peek()
-    if not next_:
+    if tokens[pos][0] == EOF:
         raise ParseError("Unexpected end of input in create statement")
 
-    if next_.type == "TABLE":
-        return _parse_create_table(it)
-    elif next_.type == "INDEX":
-        return _parse_create_index(it)
+    if tokens[pos][0] == TABLE:
+        return _parse_create_table(tokens, pos)
+    elif tokens[pos][0] == INDEX:
+        return _parse_create_index(tokens, pos)
     else:
-        raise ParseError(f"Unexpected {next_!r} in create statement")
+        raise ParseError(f"Unexpected {_describe(tokens[pos])} in create statement")
 
 
-def _parse_create_table(it):
-    _expect(it, "TABLE")
+def _parse_create_table(tokens, pos):
+    _, pos = _expect(tokens, pos, TABLE)
 
-    table_name = _expect(it, "NAME").text
+    table_name, pos = _expect(tokens, pos, NAME)
 
-    _expect(it, "LPAREN")
+    _, pos = _expect(tokens, pos, LPAREN)
     columns = []
     first = True
-    while it.peek() and it.peek().type != "RPAREN":
+    # This loop runs for every token of the column definitions, so _expect is
+    # inlined here and only called when it's going to raise
+    while tokens[pos][0] not in (RPAREN, EOF):
         if first:
             first = False
         else:
-            _expect(it, "COMMA")
-        col_name = _expect(it, "NAME").text
+            if tokens[pos][0] != COMMA:
+                _expect(tokens, pos, COMMA)
+            pos += 1
+        ty, col_name = tokens[pos]
+        if ty != NAME:
+            _expect(tokens, pos, NAME)
+        pos += 1
         type_parts = []
-        while it.peek() and it.peek().type not in ("COMMA", "RPAREN"):
-            type_parts.append(_expect(it, "NAME").text)
+        while tokens[pos][0] not in (COMMA, RPAREN, EOF):
+            ty, type_part = tokens[pos]
+            if ty != NAME:
+                _expect(tokens, pos, NAME)
+            type_parts.append(type_part)
+            pos += 1
         col_type = " ".join(type_parts)
         columns.append(CreateTableField(col_name, col_type))
 
-    _expect(it, "RPAREN")
+    _, pos = _expect(tokens, pos, RPAREN)
 
-    tok = next(it, None)
-    if tok and tok.type != "SEMICOLON":
-        raise ParseError(f"Expected end of input or semicolon, got {tok.text!r}")
+    pos = _parse_end(tokens, pos)
 
-    return CreateTableStmt(table_name, tuple(columns))
+    return CreateTableStmt(table_name, tuple(columns)), pos
 
 
-def _parse_create_index(it):
-    _expect(it, "INDEX")
+def _parse_create_index(tokens, pos):
+    _, pos = _expect(tokens, pos, INDEX)
 
-    index_name = _expect(it, "NAME").text
+    index_name, pos = _expect(tokens, pos, NAME)
 
-    _expect(it, "ON")
+    _, pos = _expect(tokens, pos, ON)
 
-    table_name = _expect(it, "NAME").text
+    table_name, pos = _expect(tokens, pos, NAME)
 
-    _expect(it, "LPAREN")
+    _, pos = _expect(tokens, pos, LPAREN)
     columns = []
     first = True
-    while it.peek() and it.peek().type != "RPAREN":
+    while tokens[pos][0] not in (RPAREN, EOF):
         if first:
             first = False
         else:
-            _expect(it, "COMMA")
-        columns.append(_expect(it, "NAME"))
+            _, pos = _expect(tokens, pos, COMMA)
+        column, pos = _expect(tokens, pos, NAME)
+        columns.append(column)
 
-    _expect(it, "RPAREN")
+    _, pos = _expect(tokens, pos, RPAREN)
 
-    tok = next(it, None)
-    if tok and tok.type != "SEMICOLON":
-        raise ParseError(f"Expected end of input or semicolon, got {tok.text!r}")
+    pos = _parse_end(tokens, pos)
 
-    return CreateIndexStmt(index_name, table_name, tuple(columns))
+    return CreateIndexStmt(index_name, table_name, tuple(columns)), pos